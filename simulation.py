@@ -1,13 +1,34 @@
 # mcandrew
 
-import sys
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scipy.interpolate import interp1d
 
-import scienceplots
+# Numba is an optional fallback for simulation when JAX is not installed
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    # Tight native loop over a preallocated state array; np.random.poisson
+    # lowers to Numba's internal generator
+    @njit(cache=True, fastmath=True)
+    def _sim_numba(N, I0, beta, gamma, dt, T):
+        state = np.empty((T + 1, 4), dtype=np.int64)
+        S, I, R, i = N - I0, I0, 0, I0
+        state[0, 0], state[0, 1], state[0, 2], state[0, 3] = S, I, R, i
+
+        for k in range(T):
+            infection = np.random.poisson(dt * (beta * S * I / N))
+            recover   = np.random.poisson(dt * (gamma * I))
+
+            S = max(0, min(N, S - infection))
+            I = max(0, min(N, I + infection - recover))
+            R = max(0, min(N, R + recover))
+            i = i + infection
+
+            state[k + 1, 0], state[k + 1, 1], state[k + 1, 2], state[k + 1, 3] = S, I, R, i
+
+        return state
 
 class compartment_forecast_with_GP(object):
     # Initialize the forecasting framework
@@ -32,50 +53,136 @@ class compartment_forecast_with_GP(object):
 
         self.y = y
 
-        # Find first missing value in y to determine training length
+        # Find first missing value in y to determine training length;
+        # argmax scans for the first True without materializing an index
+        # array, and a fully observed y trains on every point
         if y is not None:
-            self.nobs = np.min(np.argwhere(np.isnan(y)))
+            mask      = np.isnan(y)
+            self.nobs = int(mask.argmax()) if mask.any() else len(y)
         else:
             self.nobs = None
 
         self.X = X
 
     # Simulate epidemic trajectories with a stochastic SIR model
-    def simulation(self, I0=None, repo=None, dt=1./7):
-        import numpy as np
-
+    def simulation(self, I0=None, repo=None, dt=1./7, key=None, B=None):
         N = self.N
         infectious_period = self.infectious_period
         start, end = self.start, self.end
         gamma = 1. / infectious_period
+        beta  = repo * gamma
 
         S0, I0, R0, i0 = N - I0, I0, 0, I0
-        y = [(S0, I0, R0, i0)]
 
         # Time grid for simulation
-        times = np.linspace(start, end, (end - start) * int(1. / dt))
+        T     = (end - start) * int(1. / dt)
+        times = np.linspace(start, end, T)
 
-        for t in times:
-            S, I, R, i = y[-1]
-            beta = repo * gamma
+        try:
+            import jax
+            import jax.numpy as jnp
+        except ImportError:
+            # CPU-only fallback: dispatch to the compiled Numba kernel
+            if njit is None:
+                raise ImportError("simulation needs either jax or numba installed")
 
-            # Simulate infections and recoveries using Poisson noise
-            infection = np.random.poisson(dt * (beta * S * I / N))
-            recover = np.random.poisson(dt * (gamma * I))
+            if B is None:
+                y = _sim_numba(N, I0, beta, gamma, dt, T)
+                i = np.diff(y[:, 3])  # Daily incident cases
+
+                return times, i, y
+
+            y = np.stack([_sim_numba(N, I0, beta, gamma, dt, T) for _ in range(B)])
+            i = np.diff(y[:, :, 3], axis=1)  # Daily incident cases per trajectory
+
+            return times, i, y
+
+        # Derive a PRNG key from the global NumPy state when none is supplied
+        if key is None:
+            key = jax.random.PRNGKey(np.random.randint(0, 2**31 - 1))
+
+        # One SIR step: simulate infections and recoveries using Poisson noise
+        def step(carry, key):
+            S, I, R, i = carry
+            k1, k2 = jax.random.split(key)
+
+            infection = jax.random.poisson(k1, dt * (beta * S * I / N))
+            recover   = jax.random.poisson(k2, dt * (gamma * I))
 
             # Update compartments (clipped to [0, N])
-            S = np.clip(S - infection, 0, N)
-            I = np.clip(I + infection - recover, 0, N)
-            R = np.clip(R + recover, 0, N)
-            i += infection
+            S = jnp.clip(S - infection, 0, N)
+            I = jnp.clip(I + infection - recover, 0, N)
+            R = jnp.clip(R + recover, 0, N)
+            i = i + infection
+
+            return (S, I, R, i), (S, I, R, i)
+
+        # All T steps of one trajectory run as one compiled scan, shaped (T, 4)
+        def run_one(key):
+            init = (jnp.int32(S0), jnp.int32(I0), jnp.int32(R0), jnp.int32(i0))
+            _, (S, I, R, i) = jax.lax.scan(step, init, jax.random.split(key, T))
+            return jnp.stack([S, I, R, i], axis=-1)
+
+        if B is None:
+            y = np.vstack([(S0, I0, R0, i0), np.asarray(jax.jit(run_one)(key))])
+            i = np.diff(y[:, 3])  # Daily incident cases
 
-            y.append((S, I, R, i))
+            return times, i, y
 
-        S, I, R, i = zip(*y)
-        i = np.diff(i)  # Daily incident cases
+        # B trajectories broadcast through a single vmapped XLA graph, shaped (B, T, 4)
+        run = jax.jit(jax.vmap(run_one))
+        y   = np.asarray(run(jax.random.split(key, B)))
+        y   = np.concatenate([np.tile([(S0, I0, R0, i0)], (B, 1, 1)), y], axis=1)
+        i   = np.diff(y[:, :, 3], axis=1)  # Daily incident cases per trajectory
 
         return times, i, y
 
+    # Simulate one trajectory and aggregate its daily incidence up to the
+    # weekly scale inside a single jitted graph, returning a device array
+    # that feeds control_fit with no host round-trip
+    def _simulate_and_aggregate(self, I0=None, repo=None, dt=1./7, key=None):
+        from functools import partial
+
+        import jax
+        import jax.numpy as jnp
+
+        N = self.N
+        start, end = self.start, self.end
+        gamma = 1. / self.infectious_period
+        beta  = repo * gamma
+
+        T      = (end - start) * int(1. / dt)
+        nweeks = end - start
+
+        # Derive a PRNG key from the global NumPy state when none is supplied
+        if key is None:
+            key = jax.random.PRNGKey(np.random.randint(0, 2**31 - 1))
+
+        @partial(jax.jit, static_argnames=("T", "nweeks"))
+        def run(key, T, nweeks):
+            def step(carry, key):
+                S, I, R, i = carry
+                k1, k2 = jax.random.split(key)
+
+                infection = jax.random.poisson(k1, dt * (beta * S * I / N))
+                recover   = jax.random.poisson(k2, dt * (gamma * I))
+
+                # Update compartments (clipped to [0, N])
+                S = jnp.clip(S - infection, 0, N)
+                I = jnp.clip(I + infection - recover, 0, N)
+                R = jnp.clip(R + recover, 0, N)
+
+                return (S, I, R, i + infection), infection
+
+            init = (jnp.int32(N - I0), jnp.int32(I0), jnp.int32(0), jnp.int32(I0))
+            _, infections = jax.lax.scan(step, init, jax.random.split(key, T))
+
+            # XLA fuses the weekly aggregation with the scan; float output
+            # so NaN can mark the unobserved weeks downstream
+            return infections.reshape(nweeks, -1).sum(-1).astype(float)
+
+        return run(key, T, nweeks)
+
     # Fit model to control scenario using NumPyro and GP residuals
     def control_fit(self, dt=1./7):
         import jax
@@ -86,7 +193,17 @@ class compartment_forecast_with_GP(object):
         from numpyro.infer import MCMC, NUTS
         from diffrax import diffeqsolve, ODETerm, Heun, SaveAt
 
-        def model(y=None, times=None, N=None, forecast = False):
+        # Pairwise squared feature distances are constant across NUTS steps;
+        # precompute them per block so each kernel call only rescales them by
+        # the sampled amplitude and lengthscale
+        if self.X.shape[-1] > 1:
+            F        = np.asarray(self.X)[:, 1:]
+            F_o, F_p = F[:self.nobs], F[self.nobs:]
+            D2_oo    = jnp.asarray(((F_o[:, None, :] - F_o[None, :, :])**2).sum(-1))
+            D2_ot    = jnp.asarray(((F_o[:, None, :] - F_p[None, :, :])**2).sum(-1))
+            D2_tt    = jnp.asarray(((F_p[:, None, :] - F_p[None, :, :])**2).sum(-1))
+
+        def model(y=None, times=None, N=None):
             # Define SIR ODE system
             def f(t, y, args):
                 S, I, R, i = y
@@ -127,15 +244,10 @@ class compartment_forecast_with_GP(object):
             #--setup residual vector
             nobs = self.nobs
 
-            #resid_center   = jnp.nanmean(y)
-            resid          = (y.reshape(-1,) - inc )[:nobs]
-
-            # Define RBF kernel (optional for multiple covariates)
-            def rbf_kernel_ard(X1, X2, amplitude, lengthscales):
-                X1_scaled = X1 / lengthscales
-                X2_scaled = X2 / lengthscales
-                dists = jnp.sum((X1_scaled[:, None, :] - X2_scaled[None, :, :])**2, axis=-1)
-                return amplitude**2 * jnp.exp(-0.5 * dists)
+            # RBF kernel over precomputed squared distances (optional for
+            # multiple covariates); only the rescale depends on the sample
+            def rbf_kernel(D2, amplitude, lengthscales):
+                return amplitude**2 * jnp.exp(-0.5 * D2 / lengthscales**2)
 
             def random_walk_kernel(X, X2=None, variance=1.0):
                 if X2 is None:
@@ -144,27 +256,48 @@ class compartment_forecast_with_GP(object):
 
             noise  = numpyro.sample("noise", dist.HalfCauchy(1.))
             ncols  = X.shape[-1]
-            
+
+            # Split covariates into observed and forecast rows so only the
+            # nobs x nobs block is ever built in full and factorized
+            X_o, X_p = X[:nobs], X[nobs:]
+            npred    = X_p.shape[0]
+
             rw_var = numpyro.sample("rw_var", dist.HalfCauchy(1.))
-            K1     = random_walk_kernel(X[:, 0].reshape(-1, 1), variance=rw_var)
 
             # Optionally add RBF kernel if extra features exist
             if ncols > 1:
+                K1_oo = random_walk_kernel(X_o[:, 0].reshape(-1, 1), variance=rw_var)
+                K1_ot = random_walk_kernel(X_o[:, 0].reshape(-1, 1), X_p[:, 0].reshape(-1, 1), variance=rw_var)
+                K1_tt = random_walk_kernel(X_p[:, 0].reshape(-1, 1), X_p[:, 0].reshape(-1, 1), variance=rw_var)
+
                 amp  = numpyro.sample("amp", dist.Beta(1., 1.))
                 leng = numpyro.sample("leng", dist.HalfCauchy(1.))
-                K2   = rbf_kernel_ard(X[:, 1:], X[:, 1:], amp, leng)
-                K    = K1 + K2
+                K_oo = K1_oo + rbf_kernel(D2_oo, amp, leng)
+                K_ot = K1_ot + rbf_kernel(D2_ot, amp, leng)
+                K_tt = K1_tt + rbf_kernel(D2_tt, amp, leng)
+
+                # Blocks for GP residual conditioning
+                KOO = K_oo + noise * jnp.eye(nobs)
+                KTT = numpyro.deterministic("KTT", K_tt)
+                KOT = numpyro.deterministic("KOT", K_ot)
+
+                # Factor KOO once; scale_tril spares the MVN its internal
+                # Cholesky and the same factor is reused at prediction time
+                L = numpyro.deterministic("KOO_chol", jnp.linalg.cholesky(KOO + 1e-5 * jnp.eye(nobs)))
+
+                training_resid = numpyro.sample("training_resid", dist.MultivariateNormal(0, scale_tril=L))
             else:
-                K = K1
+                # GaussianRandomWalk exposes the walk's O(n) increment
+                # structure to the sampler directly, so no dense covariance
+                # build or Cholesky is needed. The forecast-window residuals
+                # fall out of the sampled walk with no conditioning solve.
+                rw  = numpyro.sample("rw", dist.GaussianRandomWalk(scale=jnp.sqrt(rw_var), num_steps=nobs + npred))
+                eps = numpyro.sample("obs_eps", dist.Normal(0., 1.).expand([nobs]).to_event(1))
 
-            # Compute submatrices for GP residual conditioning
-            KOO = numpyro.deterministic("KOO", K[:nobs, :nobs] + noise * jnp.eye(nobs))
-            KTT = numpyro.deterministic("KTT", K[nobs:, nobs:]                        )
-            KOT = numpyro.deterministic("KOT", K[:nobs, nobs:]                        )
+                training_resid = rw[:nobs] + jnp.sqrt(noise) * eps
+                numpyro.deterministic("forecast_resid", rw[nobs:])
 
-        
             # Poisson observation model on residual-corrected prediction
-            training_resid = numpyro.sample("training_resid", dist.MultivariateNormal(0, covariance_matrix = KOO))
             numpyro.sample("likelihood",
                            dist.Poisson(inc[:nobs] + training_resid),
                            obs=y[:nobs])
@@ -173,79 +306,91 @@ class compartment_forecast_with_GP(object):
             #                                 dist.MultivariateNormal( inc[:nobs] , covariance_matrix = KOO) ,
             #                                 obs=y[:nobs])
 
-            # Compute conditional GP mean and covariance
+        # Run MCMC with NUTS; chains are batched into one compiled graph
+        # rather than looped through Python one at a time
+        mcmc = MCMC(NUTS(model, max_tree_depth=3, dense_mass=True)
+                    , num_warmup=5000, num_samples=5000
+                    , num_chains=4, chain_method="vectorized", progress_bar=False)
+        # Convert the fixed inputs to device arrays once; both the sampler
+        # and the predictive step reuse them (N stays a plain Python int)
+        y_j = jnp.asarray(self.y)
+        t_j = jnp.asarray(self.times)
 
-            
-            if forecast:
-                L     = jnp.linalg.cholesky(KOO + 1e-5 * jnp.eye(nobs))
-            
-                alpha = jax.scipy.linalg.solve_triangular(L  , resid, lower=True)
-                alpha = jax.scipy.linalg.solve_triangular(L.T, alpha, lower=False)
+        mcmc.run(jax.random.PRNGKey(1), y=y_j, times=t_j, N=self.N)
+
+        mcmc.print_summary()
+        samples = mcmc.get_samples()
+
+        # Generate posterior predictive samples from the per-sample kernel
+        # blocks recorded during MCMC; re-running the model through
+        # Predictive would redo the ODE solve and GP conditioning per sample
+        nobs  = self.nobs
+        y_vec = y_j.reshape(-1,)
+        keys  = jax.random.split(jax.random.PRNGKey(2), samples["inc"].shape[0])
+
+        if self.X.shape[-1] > 1:
+            def _predict(key, inc, L, KOT, KTT):
+                resid = (y_vec - inc)[:nobs]
+
+                # Compute conditional GP mean and covariance from the
+                # factor recorded during MCMC
+                alpha = jax.scipy.linalg.cho_solve((L, True), resid)
 
                 mean = KOT.T @ alpha
 
                 v    = jax.scipy.linalg.solve_triangular(L, KOT, lower=True)
                 cov  = KTT - v.T @ v
 
-                fitted_resid = numpyro.sample("fitted_resid", dist.MultivariateNormal(mean, covariance_matrix=cov))
-                final_resid  = jnp.concatenate([resid[:nobs], fitted_resid]) 
+                k1, k2       = jax.random.split(key)
+                Lp           = jnp.linalg.cholesky(cov + 1e-5 * jnp.eye(cov.shape[0]))
+                fitted_resid = mean + Lp @ jax.random.normal(k1, (cov.shape[0],))
+                final_resid  = jnp.concatenate([resid, fitted_resid])
 
-                yhat_mean = numpyro.deterministic("yhat_mean", inc + final_resid)
-                yhat_obs  = numpyro.sample("yhat_obs", dist.Poisson(jnp.clip( inc + final_resid,10**-5,jnp.inf) ) )
-                yhat      = numpyro.deterministic("yhat", jnp.concatenate( [yhat_mean[:nobs], yhat_obs[nobs:]])) 
+                yhat_mean = inc + final_resid
+                yhat_obs  = jax.random.poisson(k2, jnp.clip(inc + final_resid, 10**-5, jnp.inf))
 
-                print(len(yhat))
-                
-            #yhat      = numpyro.sample("yhat", dist.Normal( inc + final_resid, jnp.clip(inc + final_resid,10**-5,jnp.inf) ) )
-            
+                return jnp.concatenate([yhat_mean[:nobs], yhat_obs[nobs:]])
 
-        # Run MCMC with NUTS sampler
-        mcmc = MCMC(NUTS(model, max_tree_depth=3), num_warmup=5000, num_samples=5000)
-        mcmc.run(jax.random.PRNGKey(1), y=jnp.array(self.y), times=jnp.array(self.times), N=self.N)
-
-        mcmc.print_summary()
-        samples = mcmc.get_samples()
-        #incs    = samples["yhat"]
+            yhats = jax.vmap(_predict)(keys, samples["inc"], samples["KOO_chol"], samples["KOT"], samples["KTT"])
+        else:
+            # Random-walk-only fits sample the forecast-window residuals
+            # jointly during MCMC, so no conditioning solve is left to do
+            def _predict(key, inc, forecast_resid):
+                resid       = (y_vec - inc)[:nobs]
+                final_resid = jnp.concatenate([resid, forecast_resid])
 
-        # Generate posterior predictive samples using previously drawn MCMC samples
-        from numpyro.infer import Predictive
+                yhat_mean = inc + final_resid
+                yhat_obs  = jax.random.poisson(key, jnp.clip(inc + final_resid, 10**-5, jnp.inf))
 
-        # Define model as used in control_fit (reusing trace)
-        predictive = Predictive(model
-                                ,posterior_samples=samples
-                                ,return_sites=["yhat"])
+                return jnp.concatenate([yhat_mean[:nobs], yhat_obs[nobs:]])
 
-        preds = predictive(jax.random.PRNGKey(2)
-                           ,y        = jnp.array(self.y)
-                           ,times    = jnp.array(self.times)
-                           ,N        = self.N
-                           ,forecast = True)
+            yhats = jax.vmap(_predict)(keys, samples["inc"], samples["forecast_resid"])
 
-        yhats = preds["yhat"]
-        
         self.samples = samples
-        return times, yhats, samples
+        # Return the framework's own time grid; the bare name `times` here
+        # would fall through to a module global that no longer exists now
+        # that __main__ simulates through _simulate_and_aggregate
+        return self.times, yhats, samples
     
 if __name__ == "__main__":
 
+    import jax.numpy as jnp
+
     np.random.seed(1010)
 
-    #--this simulation is at a daily temporal scale
+    #--daily temporal scale simulation, aggregated to weeks on device
     framework = compartment_forecast_with_GP(N                   = 1000
                                              , start             = 0
-                                             , end               = 32 
+                                             , end               = 32
                                              , infectious_period = 2)
-    times, infections, all_states = framework.simulation(I0=5,repo=2)
+    weekly_infections = framework._simulate_and_aggregate(I0=5,repo=2)
 
-    #--aggregating up to week temporal scale
-    weeks              = np.arange(0,32)
-    weekly_infections  = infections.reshape(32,-1).sum(-1)
+    weeks = np.arange(0,32)
 
     #--lets further assume we know only the first 10 time units
-    full_weekly_infections = weekly_infections
-    
-    weekly_infections = np.array([ float(x) for x in weekly_infections])
-    weekly_infections[10:] = np.nan
+    full_weekly_infections = np.asarray(weekly_infections)
+
+    weekly_infections = jnp.where(jnp.arange(32) >= 10, jnp.nan, weekly_infections)
 
     #--time paraemters
     start,end = min(weeks), max(weeks)+1
@@ -264,6 +409,11 @@ if __name__ == "__main__":
 
     
 
+    #--plotting stack imported here so simulation-only importers skip it
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import scienceplots
+
     colors = sns.color_palette("tab10",2)
     plt.style.use("science")
     
@@ -274,10 +424,12 @@ if __name__ == "__main__":
 
     ax.axvline(9,color="black",ls="--")
     
-    lower1,lower2,lower3,middle,upper3,upper2,upper1 = np.percentile(infections,[2.5, 10, 25,50,75,90,97.5],axis=0)
+    #--one selection pass over an explicit, C-contiguous host copy
+    infections_np = np.ascontiguousarray(np.asarray(infections))
+    lower1,lower2,lower3,middle,upper3,upper2,upper1 = np.quantile(infections_np,[0.025, 0.10, 0.25,0.50,0.75,0.90,0.975],axis=0)
     ax.fill_between(weeks,lower1,upper1,alpha=0.2       ,color=colors[0])
     ax.fill_between(weeks,lower2,upper2,alpha=0.2       ,color=colors[0])
-    ax.fill_between(weeks,lower2,upper2,alpha=0.2       ,color=colors[0])
+    ax.fill_between(weeks,lower3,upper3,alpha=0.2       ,color=colors[0])
     ax.plot(        weeks,middle                 ,lw=1.5, color=colors[0])
     
     plt.show()
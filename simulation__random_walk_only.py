@@ -1,13 +1,6 @@
 # mcandrew
 
-import sys
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scipy.interpolate import interp1d
-
-import scienceplots
 
 class compartment_forecast_with_GP(object):
     # Initialize the forecasting framework
@@ -32,9 +25,12 @@ class compartment_forecast_with_GP(object):
 
         self.y = y
 
-        # Find first missing value in y to determine training length
+        # Find first missing value in y to determine training length;
+        # argmax scans for the first True without materializing an index
+        # array, and a fully observed y trains on every point
         if y is not None:
-            self.nobs = np.min(np.argwhere(np.isnan(y)))
+            mask      = np.isnan(y)
+            self.nobs = int(mask.argmax()) if mask.any() else len(y)
         else:
             self.nobs = None
 
@@ -48,33 +44,35 @@ class compartment_forecast_with_GP(object):
         infectious_period = self.infectious_period
         start, end = self.start, self.end
         gamma = 1. / infectious_period
+        beta  = repo * gamma
 
-        S0, I0, R0, i0 = N - I0, I0, 0, I0
-        y = [(S0, I0, R0, i0)]
+        S, I, R, i = N - I0, I0, 0, I0
 
         # Time grid for simulation
-        times = np.linspace(start, end, (end - start) * int(1. / dt))
+        T     = (end - start) * int(1. / dt)
+        times = np.linspace(start, end, T)
 
-        for t in times:
-            S, I, R, i = y[-1]
-            beta = repo * gamma
+        # Preallocated state array; each row is (S, I, R, cumulative i)
+        state    = np.empty((T + 1, 4), dtype=np.int64)
+        state[0] = (S, I, R, i)
 
+        for k in range(T):
             # Simulate infections and recoveries using Poisson noise
             infection = np.random.poisson(dt * (beta * S * I / N))
             recover = np.random.poisson(dt * (gamma * I))
 
-            # Update compartments (clipped to [0, N])
-            S = np.clip(S - infection, 0, N)
-            I = np.clip(I + infection - recover, 0, N)
-            R = np.clip(R + recover, 0, N)
+            # Update compartments (clamped to [0, N]); state is scalar, so
+            # builtin min/max avoids three np.clip ufunc dispatches per step
+            S = max(0, min(N, S - infection))
+            I = max(0, min(N, I + infection - recover))
+            R = max(0, min(N, R + recover))
             i += infection
 
-            y.append((S, I, R, i))
+            state[k + 1] = (S, I, R, i)
 
-        S, I, R, i = zip(*y)
-        i = np.diff(i)  # Daily incident cases
+        i = np.diff(state[:, 3])  # Daily incident cases
 
-        return times, i, y
+        return times, i, state
 
     # Fit model to control scenario using NumPyro and GP residuals
     def control_fit(self, dt=1./7):
@@ -86,16 +84,30 @@ class compartment_forecast_with_GP(object):
         from numpyro.infer import MCMC, NUTS
         from diffrax import diffeqsolve, ODETerm, Heun, SaveAt
 
+        # Pairwise squared feature distances are constant across NUTS steps;
+        # precompute them per block so each kernel call only rescales them by
+        # the sampled amplitude and lengthscale
+        if self.X.shape[-1] > 1:
+            F        = np.asarray(self.X)[:, 1:]
+            F_o, F_p = F[:self.nobs], F[self.nobs:]
+            D2_oo    = jnp.asarray(((F_o[:, None, :] - F_o[None, :, :])**2).sum(-1))
+            D2_ot    = jnp.asarray(((F_o[:, None, :] - F_p[None, :, :])**2).sum(-1))
+            D2_tt    = jnp.asarray(((F_p[:, None, :] - F_p[None, :, :])**2).sum(-1))
+
+        # y is fixed data, so center it once here; recomputing the NaN-masked
+        # mean inside the model would rerun an O(n) reduction every leapfrog
+        # step
+        center = float(np.nanmean(np.asarray(self.y)))
+
         def model(y=None, times=None, N=None):
-            #--setup residual vector
+            #--setup residual vector (nobs is a plain Python int, so tracing
+            #--treats it and the slices below as static)
             nobs = self.nobs
 
-            # Define RBF kernel (optional for multiple covariates)
-            def rbf_kernel_ard(X1, X2, amplitude, lengthscales):
-                X1_scaled = X1 / lengthscales
-                X2_scaled = X2 / lengthscales
-                dists = jnp.sum((X1_scaled[:, None, :] - X2_scaled[None, :, :])**2, axis=-1)
-                return amplitude**2 * jnp.exp(-0.5 * dists)
+            # RBF kernel over precomputed squared distances (optional for
+            # multiple covariates); only the rescale depends on the sample
+            def rbf_kernel(D2, amplitude, lengthscales):
+                return amplitude**2 * jnp.exp(-0.5 * D2 / lengthscales**2)
 
             def random_walk_kernel(X, X2=None, variance=1.0):
                 if X2 is None:
@@ -106,33 +118,43 @@ class compartment_forecast_with_GP(object):
             sigma_obs  = numpyro.sample("sigma_obs", dist.HalfCauchy(1.))
             
             ncols  = X.shape[-1]
+
+            # Split covariates into observed and forecast rows so only the
+            # nobs x nobs block is ever built in full and factorized
+            X_o, X_p = X[:nobs], X[nobs:]
+
             rw_var = numpyro.sample("rw_var", dist.HalfCauchy(1.))
-            K1     = random_walk_kernel(X[:, 0].reshape(-1, 1), variance=rw_var)
+            K1_oo  = random_walk_kernel(X_o[:, 0].reshape(-1, 1), variance=rw_var)
+            K1_ot  = random_walk_kernel(X_o[:, 0].reshape(-1, 1), X_p[:, 0].reshape(-1, 1), variance=rw_var)
+            K1_tt  = random_walk_kernel(X_p[:, 0].reshape(-1, 1), X_p[:, 0].reshape(-1, 1), variance=rw_var)
 
             # Optionally add RBF kernel if extra features exist
             if ncols > 1:
                 amp  = numpyro.sample("amp", dist.Beta(1., 1.))
                 leng = numpyro.sample("leng", dist.HalfCauchy(1.))
-                K2   = rbf_kernel_ard(X[:, 1:], X[:, 1:], amp, leng)
-                K    = K1 + K2
+                K_oo = K1_oo + rbf_kernel(D2_oo, amp, leng)
+                K_ot = K1_ot + rbf_kernel(D2_ot, amp, leng)
+                K_tt = K1_tt + rbf_kernel(D2_tt, amp, leng)
             else:
-                K = K1
+                K_oo, K_ot, K_tt = K1_oo, K1_ot, K1_tt
 
-            # Compute submatrices for GP residual conditioning
-            KOO = K[:nobs, :nobs] + noise * jnp.eye(nobs)
-            KTT = K[nobs:, nobs:]
-            KOT = K[:nobs, nobs:]
+            # Blocks for GP residual conditioning
+            KOO = K_oo + noise * jnp.eye(nobs)
+            KTT = K_tt
+            KOT = K_ot
 
-            center         = jnp.nanmean(y)
-            centered_y     = (y-center)[:nobs]
-            
-            # Poisson observation model on residual-corrected prediction
+            centered_y     = y[:nobs] - center
+
+            # Factor KOO once; scale_tril spares the MVN its internal
+            # Cholesky and the same factor drives the conditioning solves
+            L = jnp.linalg.cholesky(KOO + 1e-5 * jnp.eye(nobs))
+
+            # Gaussian observation model on the centered residuals
             numpyro.sample("likelihood",
-                           dist.MultivariateNormal(0,covariance_matrix=KOO),
+                           dist.MultivariateNormal(0, scale_tril=L),
                            obs=centered_y)
 
             # Compute conditional GP mean and covariance
-            L     = jnp.linalg.cholesky(KOO + 1e-5 * jnp.eye(nobs))
             alpha = jax.scipy.linalg.solve_triangular(L, centered_y, lower=True)
             alpha = jax.scipy.linalg.solve_triangular(L.T, alpha, lower=False)
 
@@ -146,9 +168,17 @@ class compartment_forecast_with_GP(object):
 
             yhat = numpyro.deterministic("yhat", final_resid)
 
-        # Run MCMC with NUTS sampler
-        mcmc = MCMC(NUTS(model, max_tree_depth=3), num_warmup=5000, num_samples=5000)
-        mcmc.run(jax.random.PRNGKey(1), y=jnp.array(self.y), times=jnp.array(self.times), N=self.N)
+        # Run MCMC with NUTS; chains are batched into one compiled graph
+        # rather than looped through Python one at a time
+        mcmc = MCMC(NUTS(model, max_tree_depth=3, dense_mass=True)
+                    , num_warmup=5000, num_samples=5000
+                    , num_chains=4, chain_method="vectorized", progress_bar=False)
+        # Convert the fixed inputs to device arrays once; both the sampler
+        # and the predictive step reuse them (N stays a plain Python int)
+        y_j = jnp.asarray(self.y)
+        t_j = jnp.asarray(self.times)
+
+        mcmc.run(jax.random.PRNGKey(1), y=y_j, times=t_j, N=self.N)
 
         mcmc.print_summary()
         samples = mcmc.get_samples()
@@ -163,8 +193,8 @@ class compartment_forecast_with_GP(object):
                                 ,return_sites=["yhat"])
 
         preds = predictive(jax.random.PRNGKey(2)
-                           ,y     = jnp.array(self.y)
-                           ,times = jnp.array(self.times)
+                           ,y     = y_j
+                           ,times = t_j
                            ,N     = self.N)
 
 
@@ -184,14 +214,14 @@ if __name__ == "__main__":
                                              , infectious_period = 2)
     times, infections, all_states = framework.simulation(I0=5,repo=2)
 
-    #--aggregating up to week temporal scale
+    #--aggregating up to week temporal scale (float64 so NaN can mark unknowns)
     weeks              = np.arange(0,32)
-    weekly_infections  = infections.reshape(32,-1).sum(-1)
+    weekly_infections  = infections.astype(np.float64).reshape(32,-1).sum(-1)
+    del infections
 
     #--lets further assume we know only the first 10 time units
-    full_weekly_infections = weekly_infections
-    
-    weekly_infections = np.array([ float(x) for x in weekly_infections])
+    full_weekly_infections = weekly_infections.copy()
+
     weekly_infections[10:] = np.nan
 
     #--time paraemters
@@ -212,6 +242,11 @@ if __name__ == "__main__":
 
     
 
+    #--plotting stack imported here so simulation-only importers skip it
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import scienceplots
+
     colors = sns.color_palette("tab10",2)
     plt.style.use("science")
     
@@ -222,9 +257,11 @@ if __name__ == "__main__":
 
     ax.axvline(9,color="black",ls="--")
     
-    lower1,lower2,middle,upper2,upper1 = np.percentile(infections,[2.5,25,50,75,97.5],axis=0)
-    ax.fill_between(weeks,lower1,upper1,alpha=0.2       ,color=colors[0])
+    #--one selection pass over an explicit, C-contiguous host copy
+    infections_np = np.ascontiguousarray(np.asarray(infections))
+    lower1,lower2,middle,upper2,upper1 = np.quantile(infections_np,[0.025,0.25,0.50,0.75,0.975],axis=0)
     ax.fill_between(weeks,lower1,upper1,alpha=0.2       ,color=colors[0])
+    ax.fill_between(weeks,lower2,upper2,alpha=0.2       ,color=colors[0])
     ax.plot(        weeks,middle                 ,lw=1.5, color=colors[0])
     
     plt.show()
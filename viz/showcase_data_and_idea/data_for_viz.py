@@ -1,13 +1,6 @@
 # mcandrew
 
-import sys
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scipy.interpolate import interp1d
-
-import scienceplots
 
 import pickle
 
@@ -34,9 +27,12 @@ class compartment_forecast_with_GP(object):
 
         self.y = y
 
-        # Find first missing value in y to determine training length
+        # Find first missing value in y to determine training length;
+        # argmax scans for the first True without materializing an index
+        # array, and a fully observed y trains on every point
         if y is not None:
-            self.nobs = np.min(np.argwhere(np.isnan(y)))
+            mask      = np.isnan(y)
+            self.nobs = int(mask.argmax()) if mask.any() else len(y)
         else:
             self.nobs = None
 
@@ -50,33 +46,35 @@ class compartment_forecast_with_GP(object):
         infectious_period = self.infectious_period
         start, end = self.start, self.end
         gamma = 1. / infectious_period
+        beta  = repo * gamma
 
-        S0, I0, R0, i0 = N - I0, I0, 0, I0
-        y = [(S0, I0, R0, i0)]
+        S, I, R, i = N - I0, I0, 0, I0
 
         # Time grid for simulation
-        times = np.linspace(start, end, (end - start) * int(1. / dt))
+        T     = (end - start) * int(1. / dt)
+        times = np.linspace(start, end, T)
 
-        for t in times:
-            S, I, R, i = y[-1]
-            beta = repo * gamma
+        # Preallocated state array; each row is (S, I, R, cumulative i)
+        state    = np.empty((T + 1, 4), dtype=np.int64)
+        state[0] = (S, I, R, i)
 
+        for k in range(T):
             # Simulate infections and recoveries using Poisson noise
             infection = np.random.poisson(dt * (beta * S * I / N))
             recover = np.random.poisson(dt * (gamma * I))
 
-            # Update compartments (clipped to [0, N])
-            S = np.clip(S - infection, 0, N)
-            I = np.clip(I + infection - recover, 0, N)
-            R = np.clip(R + recover, 0, N)
+            # Update compartments (clamped to [0, N]); state is scalar, so
+            # builtin min/max avoids three np.clip ufunc dispatches per step
+            S = max(0, min(N, S - infection))
+            I = max(0, min(N, I + infection - recover))
+            R = max(0, min(N, R + recover))
             i += infection
 
-            y.append((S, I, R, i))
+            state[k + 1] = (S, I, R, i)
 
-        S, I, R, i = zip(*y)
-        i = np.diff(i)  # Daily incident cases
+        i = np.diff(state[:, 3])  # Daily incident cases
 
-        return times, i, y
+        return times, i, state
 
     # Fit model to control scenario using NumPyro and GP residuals
     def control_fit(self, dt=1./7):
@@ -88,7 +86,17 @@ class compartment_forecast_with_GP(object):
         from numpyro.infer import MCMC, NUTS
         from diffrax import diffeqsolve, ODETerm, Heun, SaveAt
 
-        def model(y=None, times=None, N=None, forecast = False):
+        # Pairwise squared feature distances are constant across NUTS steps;
+        # precompute them per block so each kernel call only rescales them by
+        # the sampled amplitude and lengthscale
+        if self.X.shape[-1] > 1:
+            F        = np.asarray(self.X)[:, 1:]
+            F_o, F_p = F[:self.nobs], F[self.nobs:]
+            D2_oo    = jnp.asarray(((F_o[:, None, :] - F_o[None, :, :])**2).sum(-1))
+            D2_ot    = jnp.asarray(((F_o[:, None, :] - F_p[None, :, :])**2).sum(-1))
+            D2_tt    = jnp.asarray(((F_p[:, None, :] - F_p[None, :, :])**2).sum(-1))
+
+        def model(y=None, times=None, N=None):
             # Define SIR ODE system
             def f(t, y, args):
                 S, I, R, i = y
@@ -129,15 +137,10 @@ class compartment_forecast_with_GP(object):
             #--setup residual vector
             nobs = self.nobs
 
-            #resid_center   = jnp.nanmean(y)
-            resid          = (y.reshape(-1,) - inc )[:nobs]
-
-            # Define RBF kernel (optional for multiple covariates)
-            def rbf_kernel_ard(X1, X2, amplitude, lengthscales):
-                X1_scaled = X1 / lengthscales
-                X2_scaled = X2 / lengthscales
-                dists = jnp.sum((X1_scaled[:, None, :] - X2_scaled[None, :, :])**2, axis=-1)
-                return amplitude**2 * jnp.exp(-0.5 * dists)
+            # RBF kernel over precomputed squared distances (optional for
+            # multiple covariates); only the rescale depends on the sample
+            def rbf_kernel(D2, amplitude, lengthscales):
+                return amplitude**2 * jnp.exp(-0.5 * D2 / lengthscales**2)
 
             def random_walk_kernel(X, X2=None, variance=1.0):
                 if X2 is None:
@@ -146,74 +149,112 @@ class compartment_forecast_with_GP(object):
 
             noise  = numpyro.sample("noise", dist.HalfCauchy(1.))
             ncols  = X.shape[-1]
-            
+
+            # Split covariates into observed and forecast rows so only the
+            # nobs x nobs block is ever built in full and factorized
+            X_o, X_p = X[:nobs], X[nobs:]
+            npred    = X_p.shape[0]
+
             rw_var = numpyro.sample("rw_var", dist.HalfCauchy(1.))
-            K1     = random_walk_kernel(X[:, 0].reshape(-1, 1), variance=rw_var)
 
             # Optionally add RBF kernel if extra features exist
             if ncols > 1:
+                K1_oo = random_walk_kernel(X_o[:, 0].reshape(-1, 1), variance=rw_var)
+                K1_ot = random_walk_kernel(X_o[:, 0].reshape(-1, 1), X_p[:, 0].reshape(-1, 1), variance=rw_var)
+                K1_tt = random_walk_kernel(X_p[:, 0].reshape(-1, 1), X_p[:, 0].reshape(-1, 1), variance=rw_var)
+
                 amp  = numpyro.sample("amp", dist.Beta(1., 1.))
                 leng = numpyro.sample("leng", dist.HalfCauchy(1.))
-                K2   = rbf_kernel_ard(X[:, 1:], X[:, 1:], amp, leng)
-                K    = K1 + K2
+                K_oo = K1_oo + rbf_kernel(D2_oo, amp, leng)
+                K_ot = K1_ot + rbf_kernel(D2_ot, amp, leng)
+                K_tt = K1_tt + rbf_kernel(D2_tt, amp, leng)
+
+                # Blocks for GP residual conditioning
+                KOO = K_oo + noise * jnp.eye(nobs)
+                KTT = numpyro.deterministic("KTT", K_tt)
+                KOT = numpyro.deterministic("KOT", K_ot)
+
+                # Factor KOO once; scale_tril spares the MVN its internal
+                # Cholesky and the same factor is reused at prediction time
+                L = numpyro.deterministic("KOO_chol", jnp.linalg.cholesky(KOO + 1e-5 * jnp.eye(nobs)))
+
+                training_resid = numpyro.sample("training_resid", dist.MultivariateNormal(0, scale_tril=L))
             else:
-                K = K1
+                # GaussianRandomWalk exposes the walk's O(n) increment
+                # structure to the sampler directly, so no dense covariance
+                # build or Cholesky is needed. The forecast-window residuals
+                # fall out of the sampled walk with no conditioning solve.
+                rw  = numpyro.sample("rw", dist.GaussianRandomWalk(scale=jnp.sqrt(rw_var), num_steps=nobs + npred))
+                eps = numpyro.sample("obs_eps", dist.Normal(0., 1.).expand([nobs]).to_event(1))
 
-            # Compute submatrices for GP residual conditioning
-            KOO = numpyro.deterministic("KOO", K[:nobs, :nobs] + noise * jnp.eye(nobs))
-            KTT = numpyro.deterministic("KTT", K[nobs:, nobs:]                        )
-            KOT = numpyro.deterministic("KOT", K[:nobs, nobs:]                        )
+                training_resid = rw[:nobs] + jnp.sqrt(noise) * eps
+                numpyro.deterministic("forecast_resid", rw[nobs:])
 
-        
             # Poisson observation model on residual-corrected prediction
-            training_resid = numpyro.sample("training_resid", dist.MultivariateNormal(0, covariance_matrix = KOO))
             numpyro.sample("likelihood",
                            dist.Poisson(inc[:nobs] + training_resid),
                            obs=y[:nobs])
 
-            if forecast:
-                L     = jnp.linalg.cholesky(KOO + 1e-5 * jnp.eye(nobs))
-            
-                alpha = jax.scipy.linalg.solve_triangular(L  , resid, lower=True)
-                alpha = jax.scipy.linalg.solve_triangular(L.T, alpha, lower=False)
+        # Run MCMC with NUTS; chains are batched into one compiled graph
+        # rather than looped through Python one at a time
+        mcmc = MCMC(NUTS(model, max_tree_depth=3, dense_mass=True)
+                    , num_warmup=5000, num_samples=5000
+                    , num_chains=4, chain_method="vectorized", progress_bar=False)
+        # Convert the fixed inputs to device arrays once; both the sampler
+        # and the predictive step reuse them (N stays a plain Python int)
+        y_j = jnp.asarray(self.y)
+        t_j = jnp.asarray(self.times)
+
+        mcmc.run(jax.random.PRNGKey(1), y=y_j, times=t_j, N=self.N)
+
+        mcmc.print_summary()
+        samples = mcmc.get_samples()
+
+        # Generate posterior predictive samples from the per-sample kernel
+        # blocks recorded during MCMC; re-running the model through
+        # Predictive would redo the ODE solve and GP conditioning per sample
+        nobs  = self.nobs
+        y_vec = y_j.reshape(-1,)
+        keys  = jax.random.split(jax.random.PRNGKey(2), samples["inc"].shape[0])
+
+        if self.X.shape[-1] > 1:
+            def _predict(key, inc, L, KOT, KTT):
+                resid = (y_vec - inc)[:nobs]
+
+                # Compute conditional GP mean and covariance from the
+                # factor recorded during MCMC
+                alpha = jax.scipy.linalg.cho_solve((L, True), resid)
 
                 mean = KOT.T @ alpha
 
                 v    = jax.scipy.linalg.solve_triangular(L, KOT, lower=True)
                 cov  = KTT - v.T @ v
 
-                fitted_resid = numpyro.sample("fitted_resid", dist.MultivariateNormal(mean, covariance_matrix=cov))
-                final_resid  = jnp.concatenate([resid[:nobs], fitted_resid]) 
+                k1, k2       = jax.random.split(key)
+                Lp           = jnp.linalg.cholesky(cov + 1e-5 * jnp.eye(cov.shape[0]))
+                fitted_resid = mean + Lp @ jax.random.normal(k1, (cov.shape[0],))
+                final_resid  = jnp.concatenate([resid, fitted_resid])
 
-                yhat_mean = numpyro.deterministic("yhat_mean", inc + final_resid)
-                yhat_obs  = numpyro.sample("yhat_obs", dist.Poisson(jnp.clip( inc + final_resid,10**-5,jnp.inf) ) )
-                yhat      = numpyro.deterministic("yhat", jnp.concatenate( [yhat_mean[:nobs], yhat_obs[nobs:]])) 
+                yhat_mean = inc + final_resid
+                yhat_obs  = jax.random.poisson(k2, jnp.clip(inc + final_resid, 10**-5, jnp.inf))
 
-                print(len(yhat))
-                
-        # Run MCMC with NUTS sampler
-        mcmc = MCMC(NUTS(model, max_tree_depth=3), num_warmup=5000, num_samples=5000)
-        mcmc.run(jax.random.PRNGKey(1), y=jnp.array(self.y), times=jnp.array(self.times), N=self.N)
+                return jnp.concatenate([yhat_mean[:nobs], yhat_obs[nobs:]])
 
-        mcmc.print_summary()
-        samples = mcmc.get_samples()
+            yhats = jax.vmap(_predict)(keys, samples["inc"], samples["KOO_chol"], samples["KOT"], samples["KTT"])
+        else:
+            # Random-walk-only fits sample the forecast-window residuals
+            # jointly during MCMC, so no conditioning solve is left to do
+            def _predict(key, inc, forecast_resid):
+                resid       = (y_vec - inc)[:nobs]
+                final_resid = jnp.concatenate([resid, forecast_resid])
 
-        # Generate posterior predictive samples using previously drawn MCMC samples
-        from numpyro.infer import Predictive
+                yhat_mean = inc + final_resid
+                yhat_obs  = jax.random.poisson(key, jnp.clip(inc + final_resid, 10**-5, jnp.inf))
 
-        # Define model as used in control_fit (reusing trace)
-        predictive = Predictive(model
-                                ,posterior_samples=samples
-                                ,return_sites=["yhat"])
+                return jnp.concatenate([yhat_mean[:nobs], yhat_obs[nobs:]])
 
-        preds = predictive(jax.random.PRNGKey(2)
-                           ,y        = jnp.array(self.y)
-                           ,times    = jnp.array(self.times)
-                           ,N        = self.N
-                           ,forecast = True)
+            yhats = jax.vmap(_predict)(keys, samples["inc"], samples["forecast_resid"])
 
-        yhats = preds["yhat"]
-        
         self.samples = samples
         return times, yhats, samples
     
@@ -228,18 +269,18 @@ if __name__ == "__main__":
                                              , infectious_period = 2)
     times, infections, all_states = framework.simulation(I0=5,repo=2)
 
-    #--aggregating up to week temporal scale
+    #--aggregating up to week temporal scale (float64 so NaN can mark unknowns)
     weeks              = np.arange(0,32)
-    weekly_infections  = infections.reshape(32,-1).sum(-1)
+    weekly_infections  = infections.astype(np.float64).reshape(32,-1).sum(-1)
+    del infections
 
     #--lets further assume we know only the first 10 time units
-    full_weekly_infections = weekly_infections
+    full_weekly_infections = weekly_infections.copy()
 
     pickle.dump(weeks             , open("./viz/showcase_data_and_idea/weeks.pkl","wb"))
     pickle.dump(full_weekly_infections , open("./viz/showcase_data_and_idea/weekly_infections.pkl"     ,"wb"))
 
     
-    weekly_infections = np.array([ float(x) for x in weekly_infections])
     weekly_infections[5:] = np.nan
 
     #--time paraemters
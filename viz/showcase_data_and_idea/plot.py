@@ -183,10 +183,11 @@ if __name__ == "__main__":
     control_infections = pickle.load(open("./viz/showcase_data_and_idea/control_infections.pkl","rb"))
     control_times      = pickle.load(open("./viz/showcase_data_and_idea/control_times.pkl"     ,"rb"))
  
-    lower1,lower2,lower3,middle,upper3,upper2,upper1 = np.percentile(control_infections,[2.5, 10, 25,50,75,90,97.5],axis=0)
+    control_infections = np.ascontiguousarray(np.asarray(control_infections))
+    lower1,lower2,lower3,middle,upper3,upper2,upper1 = np.quantile(control_infections,[0.025, 0.10, 0.25,0.50,0.75,0.90,0.975],axis=0)
     ax.fill_between(weeks,lower1,upper1,alpha=0.2       ,color=colors[4])
     ax.fill_between(weeks,lower2,upper2,alpha=0.2       ,color=colors[4])
-    ax.fill_between(weeks,lower2,upper2,alpha=0.2       ,color=colors[4])
+    ax.fill_between(weeks,lower3,upper3,alpha=0.2       ,color=colors[4])
     ax.plot(        weeks,middle                 ,lw=1.5, color=colors[4])
 
     ax.set_ylim(0,100)